@@ -1,22 +1,35 @@
+import io
 import os
+import json
 import re
+import time
 import base64
+import queue
 import asyncio
-from datetime import datetime, timedelta
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from itertools import groupby
+from operator import itemgetter
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import aiosqlite
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ChatType, ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.methods import SendMessage
+from aiogram.types import Message, CallbackQuery, File, PhotoSize, InlineKeyboardMarkup, InlineKeyboardButton
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from openai import OpenAI
+from openai import AsyncOpenAI, BadRequestError
 
 
 # =======================
@@ -30,13 +43,64 @@ TZ_NAME = os.getenv("TZ", "Asia/Almaty")
 TZ = ZoneInfo(TZ_NAME)
 
 DB_PATH = os.getenv("DB_PATH", "foodbot.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
 DEBUG = os.getenv("DEBUG", "0").strip() == "1"
 
+def redact(text: str) -> str:
+    # в ссылках на файлы Telegram (и в ошибках с ними) есть токен бота — в логи и в чат он не попадает
+    return text.replace(BOT_TOKEN, "<BOT_TOKEN>")
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+class DroppingQueueHandler(QueueHandler):
+    # очередь ограничена: если stderr не успевает, лишние записи выбрасываем, а не копим в памяти
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+class BlockingStopListener(QueueListener):
+    # stop() при полной очереди: ждём место под метку остановки (поток-писатель её освобождает)
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+# логи пишет отдельный поток — event loop не ждёт запись в stderr
+LOG_QUEUE_MAX = 10000
+_log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = BlockingStopListener(_log_queue, _log_stream)
+# в очередь — только текст сообщения (с трейсбеком); время и уровень добавит _log_stream
+_log_handler = DroppingQueueHandler(_log_queue)
+_log_handler.setFormatter(RedactingFormatter("%(message)s"))
+# от библиотек (aiogram, httpx, apscheduler) — только WARNING и выше, иначе строка на каждый апдейт и запрос
+logging.basicConfig(level=logging.WARNING, handlers=[_log_handler])
+log = logging.getLogger("foodbot")
+log.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+
 # Groq (OpenAI-compatible)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "").strip()
 GROQ_MODEL = os.getenv("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct").strip()
 GROQ_BASE_URL = "https://api.groq.com/openai/v1"
-groq_client = OpenAI(api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL) if GROQ_API_KEY else None
+# 1 — отдавать Groq ссылку на файл Telegram вместо base64. В ссылке полный токен бота:
+# его увидит сторонний сервис (логи, кэш), а с токеном можно управлять ботом. Поэтому только по явному согласию
+GROQ_IMAGE_URL = os.getenv("GROQ_IMAGE_URL", "0").strip() == "1"
+# какой размер фото слать в vision: наименьший, у которого длинная сторона не меньше этого (px)
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "768"))
+# по умолчанию у клиента таймаут 10 минут — зависший запрос держал бы слот семафора
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "60"))
+# асинхронный клиент: запросы к Groq идут прямо в event loop, без потоков
+groq_client = AsyncOpenAI(
+    api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL, timeout=GROQ_TIMEOUT, max_retries=2,
+) if GROQ_API_KEY else None
+# ответ модели — JSON-объект (response_format); 0 — старый текстовый формат
+GROQ_JSON = os.getenv("GROQ_JSON", "1").strip() == "1"
+# одновременных запросов к Groq (лимиты API)
+GROQ_CONCURRENCY = int(os.getenv("GROQ_CONCURRENCY", "8"))
+groq_sem = asyncio.Semaphore(GROQ_CONCURRENCY)
 
 # Reminders
 WATER_HOUR = int(os.getenv("WATER_HOUR", "7"))
@@ -50,28 +114,78 @@ WEIGH_DOW = os.getenv("WEIGH_DOW", "sun")
 WEIGH_HOUR = int(os.getenv("WEIGH_HOUR", "10"))
 WEIGH_MIN = int(os.getenv("WEIGH_MIN", "0"))
 
-storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+class LeanMemoryStorage(MemoryStorage):
+    """MemoryStorage без пустых записей: defaultdict заводил запись на каждого, кто пишет в группу."""
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = self.storage.get(key)
+        return record.state if record else None
+
+    async def get_data(self, key: StorageKey) -> dict:
+        record = self.storage.get(key)
+        return record.data.copy() if record else {}
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        if state is None and key not in self.storage:
+            return
+        await super().set_state(key, state)
+        self._drop_if_empty(key)
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        if not data and key not in self.storage:
+            return
+        await super().set_data(key, data)
+        self._drop_if_empty(key)
+
+    def _drop_if_empty(self, key: StorageKey):
+        record = self.storage.get(key)
+        if record and record.state is None and not record.data:
+            del self.storage[key]
+
+storage = LeanMemoryStorage()
+bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML, link_preview_is_disabled=True))
 dp = Dispatcher(storage=storage)
+# групповые хендлеры текста и фото: тип чата проверяется один раз на роутер, а не в каждом фильтре
+group_router = Router(name="group")
+group_router.message.filter(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
+dp.include_router(group_router)
 
 
 # =======================
 # REGEX
 # =======================
-WEIGHT_RE = re.compile(r"(?:^|\b)(?:вес\s*)?(\d{2,3}(?:[.,]\d)?)\b", re.IGNORECASE)
-STEPS_RE = re.compile(r"(?:^|\b)(\d{3,6})\s*(?:шаг(?:ов|а)?|steps)?\b", re.IGNORECASE)
-
-ASK_MY_WEIGHT_RE = re.compile(r"(какой\s+мой\s+вес|мой\s+вес\s+сейчас|сколько\s+я\s+вешу)\b", re.IGNORECASE)
-ASK_MY_HEIGHT_RE = re.compile(r"(какой\s+мой\s+рост|мой\s+рост)\b", re.IGNORECASE)
-ASK_MY_HW_RE = re.compile(r"(какой\s+мой\s+вес\s+и\s+рост|мой\s+вес\s+и\s+рост|сколько\s+мой\s+вес\s+и\s+рост)\b", re.IGNORECASE)
-
-ASK_EATEN_TODAY_RE = re.compile(r"(сколько\s+я\s+съел|сколько\s+я\s+съела|сколько\s+калори(й|и)\s+сегодня\s+съел|сколько\s+калори(й|и)\s+сегодня\s+съела|сколько\s+калори(й|и)\s+сегодня)\b", re.IGNORECASE)
-ASK_BURNED_TODAY_RE = re.compile(r"(сколько\s+я\s+сж(е|ё)г|сколько\s+я\s+израсходовал|сколько\s+я\s+потратил|сколько\s+я\s+калори(й|и)\s+сж(е|ё)г)\b", re.IGNORECASE)
-ASK_BALANCE_RE = re.compile(r"(баланс\s+калори(й|и)|профицит|дефицит)\b", re.IGNORECASE)
-ASK_SUMMARY_RE = re.compile(r"(сводка\s+за\s+день|саммари\s+за\s+день|итоги\s+дня|итог\s+за\s+день)\b", re.IGNORECASE)
-
-CAL_RANGE_RE = re.compile(r"Калор(ии|ий|ии):\s*([0-9]{2,4})\s*[-–]\s*([0-9]{2,4})", re.IGNORECASE)
+# число в начале сообщения или после "вес"/"шаги" — без случайных "мне 35 лет"
+WEIGHT_PAT = r"(?:^|\bвес[:\s]*)(?P<w>\d{2,3}(?:[.,]\d)?)\b(?!\s*(?:шаг|steps))"
+STEPS_PAT = r"(?:^|\bшаги?[:\s]*)(?P<s>\d{3,6})\b|\b(?P<s2>\d{3,6})\s*(?:шаг(?:ов|а)?|steps)\b"
+WEIGHT_RE = re.compile(WEIGHT_PAT, re.IGNORECASE)
+STEPS_RE = re.compile(STEPS_PAT, re.IGNORECASE)
+# дешёвый префильтр: без цифр вес/шаги не ищем
+HAS_DIGIT_RE = re.compile(r"\d")
+# вес и шаги за один проход: какая группа совпала — то и записываем
+NUMBER_RE = re.compile(f"{WEIGHT_PAT}|{STEPS_PAT}", re.IGNORECASE)
+
+# вопросы — фиксированные фразы, хватает поиска подстроки в тексте в нижнем регистре
+# с одиночными пробелами. Порядок важен: "вес и рост" раньше отдельных "вес"/"рост"
+ASK_INTENTS = {
+    "hw": ("мой вес и рост",),
+    "height": ("мой рост",),
+    "weight": ("какой мой вес", "мой вес сейчас", "сколько я вешу"),
+    "eaten": ("сколько я съел", "сколько калорий сегодня", "сколько калории сегодня"),
+    "burned": ("сколько я сжег", "сколько я сжёг", "сколько я израсходовал", "сколько я потратил",
+               "сколько я калорий сжег", "сколько я калорий сжёг", "сколько я калории сжег", "сколько я калории сжёг"),
+    "balance": ("баланс калорий", "баланс калории"),
+    "summary": ("сводка за день", "саммари за день", "итоги дня", "итог за день"),
+}
+# одиночные слова — только целиком: подстрокой поймали бы "дефицита", "дефицитный" в обычной болтовне
+ASK_BALANCE_WORD_RE = re.compile(r"(?:профицит|дефицит)\b")
+# хотя бы одно из слов есть в любой фразе ASK_INTENTS (и в ASK_BALANCE_WORD_RE)
+ASK_HINTS = ("мой", "сколько", "баланс", "профицит", "дефицит", "сводка", "саммари", "итог")
+
+CAL_RANGE_RE = re.compile(r"([0-9]{2,4})\s*[-–]\s*([0-9]{2,4})")
 CORRECT_PREFIX_RE = re.compile(r"^(исправь|это|на\s*фото)\s*:?\s*(.+)$", re.IGNORECASE)
+# "это не плов, а лагман" → "лагман"
+NOT_THIS_RE = re.compile(r"^это\s+не\s+", re.IGNORECASE)
+BUT_THAT_RE = re.compile(r"\bа\s+(.+)$", re.IGNORECASE)
 
 DEFAULT_RULES = (
     "Я оцениваю еду по: белок / овощи(клетчатка) / сладкое / жирное / порция / соусы.\n"
@@ -92,38 +206,45 @@ class ProfileFlow(StatesGroup):
 # =======================
 # Helpers
 # =======================
+# таблица для str.translate: выкидывает угловые скобки за один проход
+STRIP_ANGLE = str.maketrans("", "", "<>")
+
 def mention_user_html(msg: Message, fallback_name: str) -> str:
     u = msg.from_user
     if u and u.username:
         return f"@{u.username}"
-    safe_name = (fallback_name or "пользователь").replace("<", "").replace(">", "")
+    safe_name = (fallback_name or "пользователь").translate(STRIP_ANGLE)
     return f'<a href="tg://user?id={u.id}">{safe_name}</a>'
 
-def guess_mime(file_path: str) -> str:
-    fp = (file_path or "").lower()
-    if fp.endswith(".png"):
-        return "image/png"
-    if fp.endswith(".webp"):
-        return "image/webp"
-    return "image/jpeg"
+def pick_photo(sizes: list[PhotoSize]) -> PhotoSize:
+    # Telegram отдаёт размеры по возрастанию; оригинал — только если все меньше PHOTO_MIN_SIDE
+    return next((p for p in sizes if max(p.width, p.height) >= PHOTO_MIN_SIDE), sizes[-1])
+
+MIME_BY_EXT = {"png": "image/png", "webp": "image/webp"}
+
+def guess_mime(ext: str) -> str:
+    # ext — расширение в нижнем регистре без точки; всё остальное Telegram отдаёт как jpeg
+    return MIME_BY_EXT.get(ext, "image/jpeg")
 
-def to_data_url(img_bytes: bytes, mime: str) -> str:
-    b64 = base64.b64encode(img_bytes).decode("utf-8")
+def to_data_url(img_bytes: bytes | memoryview, mime: str) -> str:
+    b64 = base64.b64encode(img_bytes).decode("ascii")
     return f"data:{mime};base64,{b64}"
 
-def parse_kcal_range(text: str):
-    m = CAL_RANGE_RE.search(text or "")
+def parse_analysis(text: str) -> dict[str, str]:
+    """ответ модели 'Поле: значение' построчно → {'блюдо': ..., 'калории': ...} за один проход"""
+    fields = {}
+    for line in (text or "").splitlines():
+        key, sep, value = line.partition(":")
+        if sep:
+            fields.setdefault(key.strip(" *-").lower(), value.strip(" *"))
+    return fields
+
+def parse_kcal_range(fields: dict[str, str]):
+    m = CAL_RANGE_RE.search(fields.get("калории") or fields.get("калорий") or "")
     if not m:
         return (None, None)
-    low = int(m.group(2)); high = int(m.group(3))
-    if low > high:
-        low, high = high, low
-    return (low, high)
-
-def kcal_mid(low, high):
-    if low is None or high is None:
-        return None
-    return int(round((low + high) / 2))
+    a, b = int(m[1]), int(m[2])
+    return (min(a, b), max(a, b))
 
 def estimate_burned_kcal_from_steps(steps: int, weight_kg: float | None):
     # Очень грубо: 0.04 ккал/шаг (70кг), масштабируем весом
@@ -139,8 +260,8 @@ def extract_correction_text(text: str) -> str | None:
     if m:
         return m.group(2).strip()
 
-    if re.match(r"^это\s+не\s+", t, flags=re.IGNORECASE):
-        m2 = re.search(r"\bа\s+(.+)$", t, flags=re.IGNORECASE)
+    if NOT_THIS_RE.match(t):
+        m2 = BUT_THAT_RE.search(t)
         if m2:
             return m2.group(1).strip()
 
@@ -149,6 +270,41 @@ def extract_correction_text(text: str) -> str | None:
 
     return None
 
+def fmt_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, TZ).isoformat(timespec="seconds")
+
+def local_day(ts: int) -> int:
+    # начало местных суток (TZ) для unix-времени — ключ daily_stats
+    return int(datetime.fromtimestamp(ts, TZ).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+_day_bounds = (0, -1)
+
+def today_bounds() -> tuple[int, int]:
+    """(start, end) сегодняшнего дня по TZ в unix-времени; пересчёт только при смене суток"""
+    global _day_bounds
+    if not _day_bounds[0] <= time.time() <= _day_bounds[1]:
+        now = datetime.now(TZ)
+        _day_bounds = (
+            int(now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()),
+            int(now.replace(hour=23, minute=59, second=59, microsecond=0).timestamp()),
+        )
+    return _day_bounds
+
+def parse_weight(m: re.Match | None) -> float | None:
+    if not m:
+        return None
+    try:
+        w = float(m["w"].replace(",", "."))
+    except ValueError:
+        return None
+    return w if 30.0 <= w <= 300.0 else None
+
+def parse_steps(m: re.Match | None) -> int | None:
+    if not m:
+        return None
+    s = int(m["s"] or m["s2"])
+    return s if 300 <= s <= 100000 else None
+
 def correction_keyboard(bot_message_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✏️ Поправить", callback_data=f"fix:{bot_message_id}")]
@@ -158,107 +314,390 @@ def correction_keyboard(bot_message_id: int) -> InlineKeyboardMarkup:
 # =======================
 # DB
 # =======================
-async def init_db():
-    db_dir = os.path.dirname(DB_PATH)
-    if db_dir and db_dir != ".":
-        os.makedirs(db_dir, exist_ok=True)
+# Применяются в init_db и к каждому соединению пула (PRAGMA действуют на соединение)
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+DB_STMT_CACHE = 256
+
+class DBPool:
+    """Долгоживущие соединения aiosqlite: одно на запись (SQLite пишет по одному) и несколько на чтение (WAL)."""
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers = readers
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._idle_readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._conns: list[aiosqlite.Connection] = []
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        # sqlite3 кэширует подготовленные запросы по тексту SQL: запас на все запросы бота
+        db = await aiosqlite.connect(self.path, cached_statements=DB_STMT_CACHE)
+        for pragma in DB_PRAGMAS:
+            await db.execute(pragma)
+        await register_functions(db)
+        if readonly:
+            # читатель случайно не начнёт запись мимо write-lock
+            await db.execute("PRAGMA query_only=1")
+        self._conns.append(db)
+        return db
+
+    async def open(self):
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            self._idle_readers.put_nowait(await self._connect(readonly=True))
+
+    async def close(self):
+        # статистика планировщика для индексов — дёшево и только там, где она устарела
+        if self._writer is not None:
+            try:
+                await self._writer.execute("PRAGMA optimize")
+            except Exception as e:
+                log.warning("PRAGMA optimize failed: %r", e)
+        for db in self._conns:
+            await db.close()
+        self._conns.clear()
+
+    @asynccontextmanager
+    async def read(self):
+        db = await self._idle_readers.get()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+            self._idle_readers.put_nowait(db)
+
+    # execute + fetch одним заходом в поток aiosqlite, без отдельного курсора
+    async def fetchall(self, sql: str, params: tuple = ()):
+        async with self.read() as db:
+            return await db.execute_fetchall(sql, params)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        rows = await self.fetchall(sql, params)
+        return rows[0] if rows else None
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            db = self._writer
+            try:
+                yield db
+            finally:
+                # не оставляем незакрытую транзакцию следующему писателю
+                if db.in_transaction:
+                    await db.rollback()
+
+db_pool = DBPool(DB_PATH, DB_READERS)
+
+
+# Write-behind: частые INSERT копятся и коммитятся пачкой (один fsync на пачку)
+WRITE_BATCH_MAX = 100
+WRITE_BATCH_DELAY = 0.5  # сек
+
+_write_q: asyncio.Queue = asyncio.Queue()
+_writes_pending = 0
+
+def queue_write(sql: str, params: tuple):
+    global _writes_pending
+    _writes_pending += 1
+    _write_q.put_nowait((sql, params, None))
+
+async def flush_writes():
+    # читатели зовут перед SELECT, чтобы видеть свои же записи
+    if not _writes_pending:
+        return
+    done = asyncio.get_running_loop().create_future()
+    _write_q.put_nowait((None, None, done))
+    await done
+
+async def write_one_by_one(writes: list[tuple[str, tuple]]):
+    # медленный путь после сбоя пачки: каждая строка в своей транзакции, теряются только битые
+    try:
+        async with db_pool.write() as db:
+            for sql, params in writes:
+                try:
+                    await db.execute(sql, params)
+                    await db.commit()
+                except Exception:
+                    log.exception("DB writer dropped row: %s %r", " ".join(sql.split()), params)
+                    if db.in_transaction:
+                        await db.rollback()
+    except Exception:
+        # писатель не должен падать: иначе flush_writes() зависнет навсегда
+        log.exception("DB writer lost %d rows", len(writes))
+
+async def db_writer():
+    global _writes_pending
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_q.get()]
+        deadline = loop.time() + WRITE_BATCH_DELAY
+        # флаш (sql=None) коммитит пачку сразу, не дожидаясь таймера
+        while len(batch) < WRITE_BATCH_MAX and batch[-1][0] is not None:
+            try:
+                batch.append(await asyncio.wait_for(_write_q.get(), deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+
+        writes = [(sql, params) for sql, params, _ in batch if sql is not None]
+        if writes:
+            try:
+                async with db_pool.write() as db:
+                    for sql, group in groupby(writes, key=itemgetter(0)):
+                        await db.executemany(sql, [params for _, params in group])
+                    await db.commit()
+            except Exception:
+                # пользователю уже ответили "записал" — одна битая строка не должна утянуть всю пачку
+                log.exception("DB writer batch failed, retrying %d rows one by one", len(writes))
+                await write_one_by_one(writes)
+            _writes_pending -= len(writes)
+
+        for _, _, done in batch:
+            if done is not None and not done.done():
+                done.set_result(None)
+
+# Время везде хранится как unix-время (INTEGER); в ISO-строку — только для вывода
+# таблицы с составным PRIMARY KEY — WITHOUT ROWID: строка лежит прямо в B-дереве ключа
+SCHEMA = {
+    "chats": """
         CREATE TABLE IF NOT EXISTS chats(
             chat_id INTEGER PRIMARY KEY,
             bound INTEGER DEFAULT 0,
             goal TEXT DEFAULT 'maintain'
-        )""")
-
-        await db.execute("""
+        )""",
+    "profiles": """
         CREATE TABLE IF NOT EXISTS profiles(
             chat_id INTEGER,
             user_id INTEGER,
             name TEXT,
             height_cm INTEGER,
             weight_kg REAL,
-            updated_at TEXT,
+            updated_at INTEGER,
             PRIMARY KEY(chat_id, user_id)
-        )""")
-
-        await db.execute("""
+        ) WITHOUT ROWID""",
+    "weights": """
         CREATE TABLE IF NOT EXISTS weights(
             chat_id INTEGER,
             user_id INTEGER,
-            dt TEXT,
+            dt INTEGER,
             weight REAL
-        )""")
-
-        await db.execute("""
+        )""",
+    "steps": """
         CREATE TABLE IF NOT EXISTS steps(
             chat_id INTEGER,
             user_id INTEGER,
-            dt TEXT,
+            dt INTEGER,
             steps INTEGER
-        )""")
-
-        await db.execute("""
+        )""",
+    "meals": """
         CREATE TABLE IF NOT EXISTS meals(
             chat_id INTEGER,
             user_id INTEGER,
-            dt TEXT,
+            dt INTEGER,
             title TEXT,
             kcal_low INTEGER,
             kcal_high INTEGER,
             bot_message_id INTEGER
-        )""")
-
-        await db.execute("""
+        )""",
+    "meal_corrections": """
         CREATE TABLE IF NOT EXISTS meal_corrections(
             chat_id INTEGER,
             user_id INTEGER,
-            dt TEXT,
+            dt INTEGER,
             bot_message_id INTEGER,
             correction_text TEXT
-        )""")
-
-        await db.execute("""
+        )""",
+    "pending_fixes": """
         CREATE TABLE IF NOT EXISTS pending_fixes(
             chat_id INTEGER,
             user_id INTEGER,
             bot_message_id INTEGER,
-            created_at TEXT,
+            created_at INTEGER,
             PRIMARY KEY(chat_id, user_id)
-        )""")
+        ) WITHOUT ROWID""",
+    # итоги дня на человека; ведут триггеры на meals/steps, day — начало суток по TZ
+    "daily_stats": """
+        CREATE TABLE IF NOT EXISTS daily_stats(
+            chat_id INTEGER,
+            user_id INTEGER,
+            day INTEGER,
+            kcal_sum INTEGER DEFAULT 0,
+            kcal_known INTEGER DEFAULT 0,
+            meals INTEGER DEFAULT 0,
+            steps INTEGER DEFAULT 0,
+            PRIMARY KEY(chat_id, user_id, day)
+        ) WITHOUT ROWID""",
+}
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_weights_chat_user_dt ON weights(chat_id, user_id, dt DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_steps_chat_user_dt ON steps(chat_id, user_id, dt DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_meals_chat_user_dt ON meals(chat_id, user_id, dt)",
+    # правки по кнопке/реплаю ищут приём пищи по сообщению бота (ORDER BY dt DESC LIMIT 1)
+    "CREATE INDEX IF NOT EXISTS idx_meals_chat_botmsg ON meals(chat_id, bot_message_id, dt DESC)",
+)
+
+def kcal_mid_sql(row: str = "") -> str:
+    # середина диапазона калорий в SQL; как round() в Python — .5 к чётному. NULL, если диапазона нет
+    return f"({row}kcal_low + {row}kcal_high) / 2 + (({row}kcal_low + {row}kcal_high) % 4 = 3)"
+
+# local_day() — функция Python, регистрируется на каждом соединении (register_functions)
+TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS trg_meals_daily_ins AFTER INSERT ON meals BEGIN
+        INSERT INTO daily_stats(chat_id, user_id, day, kcal_sum, kcal_known, meals)
+        VALUES(NEW.chat_id, NEW.user_id, local_day(NEW.dt),
+               COALESCE({kcal_mid_sql("NEW.")}, 0), {kcal_mid_sql("NEW.")} IS NOT NULL, 1)
+        ON CONFLICT(chat_id, user_id, day) DO UPDATE SET
+            kcal_sum=kcal_sum + excluded.kcal_sum,
+            kcal_known=kcal_known + excluded.kcal_known,
+            meals=meals + 1;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_meals_daily_upd AFTER UPDATE OF kcal_low, kcal_high ON meals BEGIN
+        UPDATE daily_stats SET
+            kcal_sum=kcal_sum - COALESCE({kcal_mid_sql("OLD.")}, 0) + COALESCE({kcal_mid_sql("NEW.")}, 0),
+            kcal_known=kcal_known - ({kcal_mid_sql("OLD.")} IS NOT NULL) + ({kcal_mid_sql("NEW.")} IS NOT NULL)
+        WHERE chat_id=OLD.chat_id AND user_id=OLD.user_id AND day=local_day(OLD.dt);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_steps_daily_ins AFTER INSERT ON steps BEGIN
+        INSERT INTO daily_stats(chat_id, user_id, day, steps)
+        VALUES(NEW.chat_id, NEW.user_id, local_day(NEW.dt), NEW.steps)
+        ON CONFLICT(chat_id, user_id, day) DO UPDATE SET steps=steps + excluded.steps;
+    END""",
+)
 
+# один раз, когда daily_stats появилась в базе, где уже есть история
+DAILY_STATS_BACKFILL = f"""
+BEGIN;
+INSERT INTO daily_stats(chat_id, user_id, day, kcal_sum, kcal_known, meals)
+    SELECT chat_id, user_id, local_day(dt), COALESCE(SUM({kcal_mid_sql()}), 0), COUNT({kcal_mid_sql()}), COUNT(*)
+    FROM meals GROUP BY 1, 2, 3;
+INSERT INTO daily_stats(chat_id, user_id, day, steps)
+    SELECT chat_id, user_id, local_day(dt), SUM(steps) FROM steps GROUP BY 1, 2, 3
+    ON CONFLICT(chat_id, user_id, day) DO UPDATE SET steps=excluded.steps;
+COMMIT;
+"""
+
+async def register_functions(db: aiosqlite.Connection):
+    await db.create_function("local_day", 1, local_day, deterministic=True)
+
+# колонки времени, которые в старых базах были TEXT с isoformat()
+TS_COLUMNS = {
+    "profiles": ("updated_at",),
+    "weights": ("dt",),
+    "steps": ("dt",),
+    "meals": ("dt",),
+    "meal_corrections": ("dt",),
+    "pending_fixes": ("created_at",),
+}
+
+async def migrate_ts_to_epoch(db):
+    # у колонки TEXT-affinity число всё равно сохранится строкой — таблицу пересоздаём
+    for table, ts_cols in TS_COLUMNS.items():
+        cur = await db.execute(f"PRAGMA table_info({table})")
+        cols = {row[1]: (row[2] or "").upper() for row in await cur.fetchall()}
+        if not cols or all(cols.get(c) == "INTEGER" for c in ts_cols):
+            continue
+        select = ", ".join(f"CAST(strftime('%s', {c}) AS INTEGER)" if c in ts_cols else c for c in cols)
+        await db.execute("BEGIN")
+        await db.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        await db.execute(SCHEMA[table])
+        await db.execute(f"INSERT INTO {table}({', '.join(cols)}) SELECT {select} FROM {table}_old")
+        await db.execute(f"DROP TABLE {table}_old")
         await db.commit()
 
-async def ensure_chat(chat_id: int):
+async def init_db():
+    db_dir = os.path.dirname(DB_PATH)
+    if db_dir and db_dir != ".":
+        os.makedirs(db_dir, exist_ok=True)
+
     async with aiosqlite.connect(DB_PATH) as db:
+        await register_functions(db)
+        await migrate_ts_to_epoch(db)
+        # одним скриптом: PRAGMA (journal_mode — только вне транзакции), затем вся схема в одной транзакции
+        await db.executescript(
+            "".join(f"{pragma};\n" for pragma in DB_PRAGMAS)
+            + "BEGIN;\n"
+            + "".join(f"{ddl};\n" for ddl in (*SCHEMA.values(), *INDEXES, *TRIGGERS))
+            + "COMMIT;\n"
+            # статистика для планировщика; analysis_limit держит ANALYZE быстрым на большой базе
+            + "PRAGMA analysis_limit=1000;\nANALYZE;"
+        )
+
+        cur = await db.execute("SELECT 1 FROM daily_stats LIMIT 1")
+        if not await cur.fetchone():
+            await db.executescript(DAILY_STATS_BACKFILL)
+
+        cur = await db.execute("SELECT chat_id FROM chats")
+        _known_chats.update(r[0] for r in await cur.fetchall())
+        cur = await db.execute("SELECT chat_id, user_id FROM pending_fixes")
+        _pending_fix_users.update(await cur.fetchall())
+
+# chat_id, для которых строка в chats уже точно есть
+_known_chats: set[int] = set()
+# (chat_id, user_id) с нажатой ✏️, ещё не забранной take_pending_fix
+_pending_fix_users: set[tuple[int, int]] = set()
+
+async def ensure_chat(chat_id: int):
+    if chat_id in _known_chats:
+        return
+    async with db_pool.write() as db:
         await db.execute("INSERT OR IGNORE INTO chats(chat_id) VALUES(?)", (chat_id,))
         await db.commit()
+    _known_chats.add(chat_id)
+
+# bound=1 чаты в памяти: загружаются при старте, меняются только через set_bound
+BOUND_CHATS: set[int] = set()
 
 async def set_bound(chat_id: int, bound: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE chats SET bound=? WHERE chat_id=?", (bound, chat_id))
+    async with db_pool.write() as db:
+        # создаёт строку чата и ставит флаг одним атомарным запросом (без ensure_chat)
+        await db.execute("""
+            INSERT INTO chats(chat_id, bound) VALUES(?,?)
+            ON CONFLICT(chat_id) DO UPDATE SET bound=excluded.bound
+        """, (chat_id, bound))
         await db.commit()
+    _known_chats.add(chat_id)
+    if bound:
+        BOUND_CHATS.add(chat_id)
+    else:
+        BOUND_CHATS.discard(chat_id)
 
 async def bound_chats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT chat_id FROM chats WHERE bound=1")
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
+    rows = await db_pool.fetchall("SELECT chat_id FROM chats WHERE bound=1")
+    return [r[0] for r in rows]
 
 async def set_goal(chat_id: int, goal: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE chats SET goal=? WHERE chat_id=?", (goal, chat_id))
+    async with db_pool.write() as db:
+        await db.execute("""
+            INSERT INTO chats(chat_id, goal) VALUES(?,?)
+            ON CONFLICT(chat_id) DO UPDATE SET goal=excluded.goal
+        """, (chat_id, goal))
         await db.commit()
+    _known_chats.add(chat_id)
+    _goal_cache[chat_id] = goal
+
+# цель меняется только через /goal (set_goal), поэтому кэш без TTL
+_goal_cache: dict[int, str] = {}
 
 async def get_goal(chat_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT goal FROM chats WHERE chat_id=?", (chat_id,))
-        row = await cur.fetchone()
-        return row[0] if row else "maintain"
+    goal = _goal_cache.get(chat_id)
+    if goal is None:
+        row = await db_pool.fetchone("SELECT goal FROM chats WHERE chat_id=?", (chat_id,))
+        goal = _goal_cache[chat_id] = row[0] if row and row[0] else "maintain"
+    return goal
 
 async def upsert_profile(chat_id: int, user_id: int, name: str, height_cm: int, weight_kg: float):
-    ts = datetime.now(TZ).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
+    ts = int(time.time())
+    async with db_pool.write() as db:
         await db.execute("""
         INSERT INTO profiles(chat_id, user_id, name, height_cm, weight_kg, updated_at)
         VALUES(?,?,?,?,?,?)
@@ -269,165 +708,149 @@ async def upsert_profile(chat_id: int, user_id: int, name: str, height_cm: int,
             updated_at=excluded.updated_at
         """, (chat_id, user_id, name, height_cm, weight_kg, ts))
         await db.commit()
+    _profile_cache.pop((chat_id, user_id), None)
 
-async def get_profile(chat_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def link_private_profile(chat_id: int, user_id: int):
+    # копирует личный профиль (chat_id=0) в группу одним запросом; None — профиля в личке нет
+    ts = int(time.time())
+    async with db_pool.write() as db:
         cur = await db.execute("""
-            SELECT name, height_cm, weight_kg, updated_at
-            FROM profiles WHERE chat_id=? AND user_id=?
-        """, (chat_id, user_id))
-        return await cur.fetchone()
+        INSERT INTO profiles(chat_id, user_id, name, height_cm, weight_kg, updated_at)
+        SELECT ?, user_id, name, height_cm, weight_kg, ? FROM profiles WHERE chat_id=0 AND user_id=?
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            name=excluded.name,
+            height_cm=excluded.height_cm,
+            weight_kg=excluded.weight_kg,
+            updated_at=excluded.updated_at
+        RETURNING name
+        """, (chat_id, ts, user_id))
+        row = await cur.fetchone()
+        await cur.close()
+        await db.commit()
+    _profile_cache.pop((chat_id, user_id), None)
+    return row[0] if row else None
+
+# профиль читается на каждое сообщение, а меняется только через /profile и /linkprofile
+PROFILE_CACHE_TTL = 300  # сек
+PROFILE_CACHE_MAX = 1024
+_profile_cache: OrderedDict = OrderedDict()  # (chat_id, user_id) -> (expires_at, row)
+
+async def get_profile(chat_id: int, user_id: int):
+    key = (chat_id, user_id)
+    hit = _profile_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        _profile_cache.move_to_end(key)
+        return hit[1]
+    row = await db_pool.fetchone("""
+        SELECT name, height_cm, weight_kg, updated_at
+        FROM profiles WHERE chat_id=? AND user_id=?
+    """, (chat_id, user_id))
+    # None тоже кэшируем — у большинства участников профиля нет
+    _profile_cache[key] = (time.monotonic() + PROFILE_CACHE_TTL, row)
+    _profile_cache.move_to_end(key)
+    if len(_profile_cache) > PROFILE_CACHE_MAX:
+        _profile_cache.popitem(last=False)
+    return row
 
 async def save_weight(chat_id: int, user_id: int, w: float):
-    ts = datetime.now(TZ).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO weights(chat_id, user_id, dt, weight) VALUES(?,?,?,?)",
-                         (chat_id, user_id, ts, w))
-        await db.commit()
+    ts = int(time.time())
+    queue_write("INSERT INTO weights(chat_id, user_id, dt, weight) VALUES(?,?,?,?)",
+                (chat_id, user_id, ts, w))
 
 async def last_weight(chat_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT dt, weight FROM weights WHERE chat_id=? AND user_id=? ORDER BY dt DESC LIMIT 1",
-            (chat_id, user_id),
-        )
-        return await cur.fetchone()
+    await flush_writes()
+    return await db_pool.fetchone(
+        "SELECT dt, weight FROM weights WHERE chat_id=? AND user_id=? ORDER BY dt DESC LIMIT 1",
+        (chat_id, user_id),
+    )
 
 async def save_steps(chat_id: int, user_id: int, s: int):
-    ts = datetime.now(TZ).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO steps(chat_id, user_id, dt, steps) VALUES(?,?,?,?)",
-                         (chat_id, user_id, ts, s))
-        await db.commit()
+    ts = int(time.time())
+    queue_write("INSERT INTO steps(chat_id, user_id, dt, steps) VALUES(?,?,?,?)",
+                (chat_id, user_id, ts, s))
 
 async def steps_today(chat_id: int, user_id: int) -> int:
-    start = datetime.now(TZ).replace(hour=0, minute=0, second=0, microsecond=0).isoformat(timespec="seconds")
-    end = datetime.now(TZ).replace(hour=23, minute=59, second=59, microsecond=0).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT COALESCE(SUM(steps), 0) FROM steps
-            WHERE chat_id=? AND user_id=? AND dt BETWEEN ? AND ?
-        """, (chat_id, user_id, start, end))
-        row = await cur.fetchone()
-        return int(row[0] or 0)
+    return (await day_totals_today(chat_id, user_id))[3]
 
 async def save_meal(chat_id: int, user_id: int, title: str, kcal_low: int | None, kcal_high: int | None, bot_message_id: int):
-    ts = datetime.now(TZ).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO meals(chat_id, user_id, dt, title, kcal_low, kcal_high, bot_message_id) VALUES(?,?,?,?,?,?,?)",
-            (chat_id, user_id, ts, title, kcal_low, kcal_high, bot_message_id)
-        )
-        await db.commit()
-
-async def meals_today(chat_id: int, user_id: int):
-    start = datetime.now(TZ).replace(hour=0, minute=0, second=0, microsecond=0).isoformat(timespec="seconds")
-    end = datetime.now(TZ).replace(hour=23, minute=59, second=59, microsecond=0).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT dt, title, kcal_low, kcal_high, bot_message_id FROM meals
-            WHERE chat_id=? AND user_id=? AND dt BETWEEN ? AND ?
-            ORDER BY dt ASC
-        """, (chat_id, user_id, start, end))
-        return await cur.fetchall()
+    ts = int(time.time())
+    queue_write("INSERT INTO meals(chat_id, user_id, dt, title, kcal_low, kcal_high, bot_message_id) VALUES(?,?,?,?,?,?,?)",
+                (chat_id, user_id, ts, title, kcal_low, kcal_high, bot_message_id))
+
+async def day_totals_today(chat_id: int, user_id: int) -> tuple[int, int, int, int]:
+    """returns: (total_mid, meals_count, known_count, steps) — одна строка daily_stats по первичному ключу"""
+    day, _ = today_bounds()
+    await flush_writes()
+    row = await db_pool.fetchone("""
+        SELECT kcal_sum, meals, kcal_known, steps FROM daily_stats
+        WHERE chat_id=? AND user_id=? AND day=?
+    """, (chat_id, user_id, day))
+    return tuple(row) if row else (0, 0, 0, 0)
 
 async def total_intake_today(chat_id: int, user_id: int) -> tuple[int, int, int]:
     """returns: (total_mid, meals_count, known_count)"""
-    rows = await meals_today(chat_id, user_id)
-    total = 0
-    known = 0
-    for _, _, low, high, _ in rows:
-        mid = kcal_mid(low, high)
-        if mid is not None:
-            total += mid
-            known += 1
-    return total, len(rows), known
+    total, meals, known, _ = await day_totals_today(chat_id, user_id)
+    return total, meals, known
 
 async def find_meal_by_bot_message(chat_id: int, bot_message_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT dt, title, kcal_low, kcal_high, user_id
-            FROM meals
-            WHERE chat_id=? AND bot_message_id=?
-            ORDER BY dt DESC LIMIT 1
-        """, (chat_id, bot_message_id))
-        return await cur.fetchone()
-
-async def update_meal_by_bot_message(chat_id: int, bot_message_id: int, title: str, kcal_low: int | None, kcal_high: int | None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            UPDATE meals
-            SET title=?, kcal_low=?, kcal_high=?
-            WHERE chat_id=? AND bot_message_id=?
-        """, (title, kcal_low, kcal_high, chat_id, bot_message_id))
-        await db.commit()
+    await flush_writes()
+    return await db_pool.fetchone("""
+        SELECT dt, title, kcal_low, kcal_high, user_id, rowid
+        FROM meals
+        WHERE chat_id=? AND bot_message_id=?
+        ORDER BY dt DESC LIMIT 1
+    """, (chat_id, bot_message_id))
+
+async def update_meal(meal_id: int, title: str, kcal_low: int | None, kcal_high: int | None):
+    # meal_id — rowid из find_meal_by_bot_message; в ту же очередь, что и INSERT — порядок сохраняется
+    queue_write("UPDATE meals SET title=?, kcal_low=?, kcal_high=? WHERE rowid=?",
+                (title, kcal_low, kcal_high, meal_id))
 
 async def log_correction(chat_id: int, user_id: int, bot_message_id: int, correction_text: str):
-    ts = datetime.now(TZ).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO meal_corrections(chat_id, user_id, dt, bot_message_id, correction_text)
-            VALUES(?,?,?,?,?)
-        """, (chat_id, user_id, ts, bot_message_id, correction_text))
-        await db.commit()
+    ts = int(time.time())
+    queue_write("INSERT INTO meal_corrections(chat_id, user_id, dt, bot_message_id, correction_text) VALUES(?,?,?,?,?)",
+                (chat_id, user_id, ts, bot_message_id, correction_text))
 
 async def set_pending_fix(chat_id: int, user_id: int, bot_message_id: int):
-    ts = datetime.now(TZ).isoformat(timespec="seconds")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO pending_fixes(chat_id, user_id, bot_message_id, created_at)
-            VALUES(?,?,?,?)
-            ON CONFLICT(chat_id, user_id) DO UPDATE SET
-                bot_message_id=excluded.bot_message_id,
-                created_at=excluded.created_at
-        """, (chat_id, user_id, bot_message_id, ts))
-        await db.commit()
-
-async def get_pending_fix(chat_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    ts = int(time.time())
+    queue_write("""
+        INSERT INTO pending_fixes(chat_id, user_id, bot_message_id, created_at)
+        VALUES(?,?,?,?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            bot_message_id=excluded.bot_message_id,
+            created_at=excluded.created_at
+    """, (chat_id, user_id, bot_message_id, ts))
+    _pending_fix_users.add((chat_id, user_id))
+
+async def take_pending_fix(chat_id: int, user_id: int):
+    # зовётся на каждый текст в группе — без нажатой ✏️ в базу не ходим
+    if (chat_id, user_id) not in _pending_fix_users:
+        return None
+    _pending_fix_users.discard((chat_id, user_id))
+    await flush_writes()
+    # SELECT + DELETE одним атомарным запросом: правку подхватит только одно сообщение
+    async with db_pool.write() as db:
         cur = await db.execute("""
-            SELECT bot_message_id, created_at FROM pending_fixes
+            DELETE FROM pending_fixes
             WHERE chat_id=? AND user_id=?
+            RETURNING bot_message_id, created_at
         """, (chat_id, user_id))
-        return await cur.fetchone()
-
-async def clear_pending_fix(chat_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM pending_fixes WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        row = await cur.fetchone()
+        await cur.close()
         await db.commit()
+        return row
 
 
 # =======================
 # Groq analyze
 # =======================
-async def groq_chat(messages):
-    resp = groq_client.chat.completions.create(
-        model=GROQ_MODEL,
-        messages=messages,
-        temperature=0.3,
-    )
-    return (resp.choices[0].message.content or "").strip()
-
-async def analyze_food(photo_file_id: str, goal: str, user_context: str, caption: str | None):
-    if not groq_client:
-        return "⚠️ Groq не настроен: добавь GROQ_API_KEY в Railway Variables."
+STRICTNESS = {
+    "cut": "Будь строже: меньше масла/сладкого/соусов, упор на белок и овощи.",
+    "maintain": "Баланс: по делу, без жесткача.",
+    "bulk": "Упор на белок и качество еды, без мусора.",
+}
 
-    tg_file = await bot.get_file(photo_file_id)
-    bio = await bot.download_file(tg_file.file_path)
-    img_bytes = bio.read()
-    mime = guess_mime(tg_file.file_path)
-    data_url = to_data_url(img_bytes, mime)
-
-    strictness = {
-        "cut": "Будь строже: меньше масла/сладкого/соусов, упор на белок и овощи.",
-        "maintain": "Баланс: по делу, без жесткача.",
-        "bulk": "Упор на белок и качество еды, без мусора."
-    }.get(goal, "Баланс: по делу, без жесткача.")
-
-    cap = (caption or "").strip()
-    caption_line = f"Подпись к фото: {cap}" if cap else "Подписи нет."
-
-    prompt = f"""
+FOOD_PROMPT = """
 Ты — помощник по питанию. {strictness}
 Контекст о человеке (если есть): {user_context}
 {caption_line}
@@ -435,33 +858,155 @@ async def analyze_food(photo_file_id: str, goal: str, user_context: str, caption
 По фото еды:
 1) Определи блюдо (если не уверен — 2–3 варианта).
 2) Оценка 1–10.
-3) Калории диапазоном (формат: Калории: 650-850 ккал).
+3) Калории диапазоном.
 4) Почему (1–2 предложения).
 5) 1 конкретный совет.
 
+{answer_format}
+""".strip()
+
+REFINE_PROMPT = """
+Ты — помощник по питанию. {strictness}
+Контекст о человеке (если есть): {user_context}
+
+Пользователь уточнил, что на фото: {correction_text}
+
+Сделай оценку и калорийность по описанию (если порция неизвестна — дай диапазон).
+{answer_format}
+""".strip()
+
+ANSWER_FORMAT_JSON = """
+Ответ — строго JSON-объект, без текста вокруг:
+{{"dish": "...", "score": 7, "kcal_low": 650, "kcal_high": 850, "why": "...", "tip": "..."}}
+""".strip()
+
+ANSWER_FORMAT_TEXT = """
 Формат строго:
 Блюдо:
 Оценка:
-Калории:
+Калории: 650-850 ккал
 Почему:
 Совет:
 """.strip()
 
+ANSWER_FORMAT = ANSWER_FORMAT_JSON if GROQ_JSON else ANSWER_FORMAT_TEXT
+
+# промпты собраны под каждую цель заранее; в рантайме подставляются только данные человека
+FOOD_PROMPTS = {
+    goal: FOOD_PROMPT.replace("{strictness}", text).replace("{answer_format}", ANSWER_FORMAT)
+    for goal, text in STRICTNESS.items()
+}
+REFINE_PROMPTS = {
+    goal: REFINE_PROMPT.replace("{strictness}", text).replace("{answer_format}", ANSWER_FORMAT)
+    for goal, text in STRICTNESS.items()
+}
+
+def render_analysis(raw: str) -> str:
+    """JSON от модели → привычный текст 'Поле: значение'; если это не JSON — отдаём как есть"""
+    if not GROQ_JSON:
+        return raw
     try:
-        text = await groq_chat([
+        data = json.loads(raw)
+    except ValueError:
+        return raw
+    if not isinstance(data, dict):
+        return raw
+    lines = []
+    if data.get("dish"):
+        lines.append(f"Блюдо: {data['dish']}")
+    if data.get("score") is not None:
+        lines.append(f"Оценка: {data['score']}/10")
+    if data.get("kcal_low") is not None and data.get("kcal_high") is not None:
+        lines.append(f"Калории: {data['kcal_low']}-{data['kcal_high']} ккал")
+    if data.get("why"):
+        lines.append(f"Почему: {data['why']}")
+    if data.get("tip"):
+        lines.append(f"Совет: {data['tip']}")
+    return "\n".join(lines) or raw
+
+GROQ_EXTRA = {"response_format": {"type": "json_object"}} if GROQ_JSON else {}
+
+async def groq_chat(messages):
+    async with groq_sem:
+        resp = await groq_client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=messages,
+            temperature=0.3,
+            **GROQ_EXTRA,
+        )
+    return render_analysis((resp.choices[0].message.content or "").strip())
+
+async def warm_groq():
+    # TLS-рукопожатие и пул соединений — при старте, а не на первом фото пользователя
+    if not groq_client:
+        return
+    try:
+        await groq_client.models.list()
+    except Exception as e:
+        log.warning("Groq warm-up failed: %r", e)
+
+# по таким словам в ошибке 400 видно, что Groq не смог скачать картинку по ссылке
+IMAGE_URL_ERROR_HINTS = ("image", "media", "url", "download", "fetch", "retriev")
+
+def is_image_url_error(e: BadRequestError) -> bool:
+    # невалидный JSON-ответ — тоже 400, но повтор с байтами его не исправит
+    if e.code == "json_validate_failed":
+        return False
+    body = e.body if isinstance(e.body, dict) else {}
+    text = str(body.get("message") or e.message).lower()
+    return any(h in text for h in IMAGE_URL_ERROR_HINTS)
+
+async def analyze_food(tg_file: File, goal: str, user_context: str, caption: str | None):
+    # tg_file берёт вызывающий (bot.get_file) — параллельно с чтением профиля и цели
+    if not groq_client:
+        return "⚠️ Groq не настроен: добавь GROQ_API_KEY в Railway Variables."
+
+    cap = (caption or "").strip()
+    caption_line = f"Подпись к фото: {cap}" if cap else "Подписи нет."
+    prompt = FOOD_PROMPTS.get(goal, FOOD_PROMPTS["maintain"]).format(
+        user_context=user_context, caption_line=caption_line,
+    )
+
+    def photo_messages(image_url: str):
+        return [
             {"role": "user", "content": [
                 {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": data_url}},
+                {"type": "image_url", "image_url": {"url": image_url}},
             ]}
-        ])
+        ]
+
+    try:
+        text = None
+        if GROQ_IMAGE_URL:
+            # Groq сам скачает фото по ссылке Telegram — байты не идут через бота
+            try:
+                text = await groq_chat(photo_messages(bot.session.api.file_url(BOT_TOKEN, tg_file.file_path)))
+            except BadRequestError as e:
+                # байты шлём, только если Groq не смог взять картинку по ссылке; прочие 400 — общая ошибка
+                if not is_image_url_error(e):
+                    raise
+                log.warning("Groq image URL rejected, sending bytes: %r", e)
+        if text is None:
+            buf = io.BytesIO()
+            await bot.download_file(tg_file.file_path, destination=buf, seek=False)
+            # getbuffer() — без копии содержимого BytesIO; буфер отпускаем до запроса в Groq.
+            # base64 нескольких МБ — в потоке, чтобы не стопорить остальные хендлеры
+            mime = guess_mime((tg_file.file_path or "").rsplit(".", 1)[-1].lower())
+            with buf.getbuffer() as view:
+                data_url = await asyncio.to_thread(to_data_url, view, mime)
+            buf.close()
+            text = await groq_chat(photo_messages(data_url))
         return text if text else "Не смог распознать по фото 😅 Попробуй другое фото или подпиши."
     except Exception as e:
-        err = repr(e)
-        print("Groq error:", err)
+        err = redact(repr(e))
+        log.error("Groq error: %s", err)
         low = err.lower()
         hint = "Не смог обработать фото 😅"
         if "401" in low or "unauthorized" in low:
             hint = "Проблема с GROQ_API_KEY (401)."
+        elif "json_validate_failed" in low:
+            # до проверки на "rate": в тексте этой ошибки есть "generate"
+            hint = "Модель ответила не по формату. Попробуй ещё раз."
         elif "429" in low or "rate" in low or "quota" in low:
             hint = "Groq ограничил запросы (429/лимит)."
         elif "model" in low and ("not found" in low or "does not exist" in low):
@@ -471,26 +1016,9 @@ async def analyze_food(photo_file_id: str, goal: str, user_context: str, caption
         return f"⚠️ {hint}" + (f"\n\nDEBUG: {err[:240]}" if DEBUG else "")
 
 async def reanalyze_from_text(goal: str, user_context: str, correction_text: str):
-    strictness = {
-        "cut": "Будь строже: меньше масла/сладкого/соусов, упор на белок и овощи.",
-        "maintain": "Баланс: по делу, без жесткача.",
-        "bulk": "Упор на белок и качество еды, без мусора."
-    }.get(goal, "Баланс: по делу, без жесткача.")
-
-    prompt = f"""
-Ты — помощник по питанию. {strictness}
-Контекст о человеке (если есть): {user_context}
-
-Пользователь уточнил, что на фото: {correction_text}
-
-Сделай оценку и калорийность по описанию (если порция неизвестна — дай диапазон).
-Формат строго:
-Блюдо:
-Оценка:
-Калории:
-Почему:
-Совет:
-""".strip()
+    prompt = REFINE_PROMPTS.get(goal, REFINE_PROMPTS["maintain"]).format(
+        user_context=user_context, correction_text=correction_text,
+    )
 
     try:
         text = await groq_chat([{"role": "user", "content": prompt}])
@@ -506,8 +1034,7 @@ async def day_summary_text(chat_id: int, user_id: int) -> str:
     prof = await get_profile(chat_id, user_id)
     weight_kg = float(prof[2]) if prof else None
 
-    intake, meals_cnt, known_cnt = await total_intake_today(chat_id, user_id)
-    steps = await steps_today(chat_id, user_id)
+    intake, meals_cnt, known_cnt, steps = await day_totals_today(chat_id, user_id)
     burned = estimate_burned_kcal_from_steps(steps, weight_kg)
     balance = intake - burned
 
@@ -543,60 +1070,60 @@ async def cmd_rules(msg: Message):
 async def cmd_bind(msg: Message):
     if msg.chat.type not in {ChatType.GROUP, ChatType.SUPERGROUP}:
         return await msg.reply("Эта команда нужна в группе.")
-    await ensure_chat(msg.chat.id)
     await set_bound(msg.chat.id, 1)
-    await msg.reply("Ок! Напоминания включены ✅")
+    await msg.answer("Ок! Напоминания включены ✅")
 
 @dp.message(Command("unbind"))
 async def cmd_unbind(msg: Message):
     if msg.chat.type not in {ChatType.GROUP, ChatType.SUPERGROUP}:
         return await msg.reply("Эта команда нужна в группе.")
-    await ensure_chat(msg.chat.id)
     await set_bound(msg.chat.id, 0)
-    await msg.reply("Ок! Напоминания выключены ✅")
+    await msg.answer("Ок! Напоминания выключены ✅")
 
 @dp.message(Command("goal"))
 async def cmd_goal(msg: Message):
     if msg.chat.type not in {ChatType.GROUP, ChatType.SUPERGROUP}:
         return await msg.reply("Эту команду лучше использовать в группе.")
-    await ensure_chat(msg.chat.id)
-    parts = (msg.text or "").split()
+    # нужен только первый аргумент — хвост сообщения не режем на слова
+    parts = (msg.text or "").split(maxsplit=2)
     if len(parts) < 2 or parts[1] not in {"cut", "maintain", "bulk"}:
         return await msg.reply("Формат: /goal cut | maintain | bulk")
     await set_goal(msg.chat.id, parts[1])
-    await msg.reply(f"Цель группы: {parts[1]} ✅")
+    await msg.answer(f"Цель группы: {parts[1]} ✅")
 
 
 # =======================
 # Profile FSM
 # =======================
+# в личке и для подтверждений — answer(): цитата тут не нужна, ответ меньше
 @dp.message(Command("profile"))
 async def cmd_profile(msg: Message, state: FSMContext):
     if msg.chat.type != ChatType.PRIVATE:
         return await msg.reply("Напиши мне в личку /profile — я задам 3 вопроса 🙂")
     await state.set_state(ProfileFlow.name)
-    await msg.reply("Как тебя называть? (например: Denis)")
+    await msg.answer("Как тебя называть? (например: Denis)")
 
 @dp.message(ProfileFlow.name)
 async def prof_name(msg: Message, state: FSMContext):
     name = (msg.text or "").strip()
     if not name or len(name) > 30:
-        return await msg.reply("Коротко имя (до 30 символов).")
+        return await msg.answer("Коротко имя (до 30 символов).")
     await state.update_data(name=name)
     await state.set_state(ProfileFlow.height)
-    await msg.reply("Рост в см? (например: 188)")
+    await msg.answer("Рост в см? (например: 188)")
 
 @dp.message(ProfileFlow.height)
 async def prof_height(msg: Message, state: FSMContext):
     raw = (msg.text or "").strip()
-    if not raw.isdigit():
-        return await msg.reply("Рост цифрами, например: 188")
-    h = int(raw)
+    try:
+        h = int(raw)
+    except ValueError:
+        return await msg.answer("Рост цифрами, например: 188")
     if h < 120 or h > 230:
-        return await msg.reply("Похоже на ошибку. Рост в см (пример: 188).")
+        return await msg.answer("Похоже на ошибку. Рост в см (пример: 188).")
     await state.update_data(height=h)
     await state.set_state(ProfileFlow.weight)
-    await msg.reply("Вес в кг? (например: 82.4)")
+    await msg.answer("Вес в кг? (например: 82.4)")
 
 @dp.message(ProfileFlow.weight)
 async def prof_weight(msg: Message, state: FSMContext):
@@ -604,9 +1131,9 @@ async def prof_weight(msg: Message, state: FSMContext):
     try:
         w = float(raw)
     except ValueError:
-        return await msg.reply("Вес числом, например: 82.4")
+        return await msg.answer("Вес числом, например: 82.4")
     if w < 30 or w > 300:
-        return await msg.reply("Похоже на ошибку. Вес в кг (пример: 82.4).")
+        return await msg.answer("Похоже на ошибку. Вес в кг (пример: 82.4).")
 
     data = await state.get_data()
     name = data.get("name")
@@ -615,7 +1142,7 @@ async def prof_weight(msg: Message, state: FSMContext):
 
     await upsert_profile(0, user_id, name, height, float(w))
     await state.clear()
-    await msg.reply(f"Ок, {name}! Сохранил ✅\nТеперь в группе напиши /linkprofile")
+    await msg.answer(f"Ок, {name}! Сохранил ✅\nТеперь в группе напиши /linkprofile")
 
 @dp.message(Command("linkprofile"))
 async def cmd_linkprofile(msg: Message):
@@ -623,17 +1150,10 @@ async def cmd_linkprofile(msg: Message):
         return await msg.reply("Эта команда нужна в группе.")
     await ensure_chat(msg.chat.id)
 
-    user_id = msg.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT name, height_cm, weight_kg FROM profiles WHERE chat_id=0 AND user_id=?",
-                               (user_id,))
-        row = await cur.fetchone()
-
-    if not row:
+    name = await link_private_profile(msg.chat.id, msg.from_user.id)
+    if name is None:
         return await msg.reply("Сначала заполни профиль в личке: /profile")
 
-    name, h, w = row
-    await upsert_profile(msg.chat.id, user_id, name, int(h), float(w))
     await msg.reply(f"{name}, профиль привязан ✅")
 
 
@@ -665,26 +1185,33 @@ async def cb_fix(call: CallbackQuery):
 async def answer_questions(msg: Message, mention: str, prof):
     chat_id = msg.chat.id
     user_id = msg.from_user.id
-    text = (msg.text or "").strip()
-
-    if ASK_MY_HW_RE.search(text):
+    low = " ".join((msg.text or "").lower().split())
+    # подстрока есть в каждом вопросе — "82.4" и болтовня дальше не идут
+    if not any(kw in low for kw in ASK_HINTS):
+        return False
+    intent = next((k for k, phrases in ASK_INTENTS.items()
+                   if any(p in low for p in phrases) or k == "balance" and ASK_BALANCE_WORD_RE.search(low)), None)
+    if intent is None:
+        return False
+
+    if intent == "hw":
         if not prof:
             await msg.reply(f"{mention}, у меня нет твоего профиля. В личку: /profile → затем /linkprofile в группе.")
             return True
         await msg.reply(f"{mention}, рост: {prof[1]} см, вес: {float(prof[2]):.1f} кг.")
         return True
 
-    if ASK_MY_HEIGHT_RE.search(text):
+    if intent == "height":
         if not prof:
             await msg.reply(f"{mention}, у меня нет твоего роста. В личку: /profile → затем /linkprofile в группе.")
             return True
         await msg.reply(f"{mention}, твой рост: {prof[1]} см.")
         return True
 
-    if ASK_MY_WEIGHT_RE.search(text):
+    if intent == "weight":
         lw = await last_weight(chat_id, user_id)
         if lw:
-            await msg.reply(f"{mention}, последний вес: {float(lw[1]):.1f} кг ({lw[0]}).")
+            await msg.reply(f"{mention}, последний вес: {float(lw[1]):.1f} кг ({fmt_ts(lw[0])}).")
             return True
         if prof:
             await msg.reply(f"{mention}, в профиле вес: {float(prof[2]):.1f} кг (обнови сообщением типа 82.4 при желании).")
@@ -692,21 +1219,20 @@ async def answer_questions(msg: Message, mention: str, prof):
         await msg.reply(f"{mention}, у меня пока нет твоего веса. Напиши, например: 82.4")
         return True
 
-    if ASK_EATEN_TODAY_RE.search(text):
+    if intent == "eaten":
         intake, meals_cnt, known_cnt = await total_intake_today(chat_id, user_id)
         await msg.reply(f"{mention}, сегодня съел примерно ~{intake} ккал (приёмов: {meals_cnt}, с калориями: {known_cnt}).")
         return True
 
-    if ASK_BURNED_TODAY_RE.search(text):
+    if intent == "burned":
         steps = await steps_today(chat_id, user_id)
         weight_kg = float(prof[2]) if prof else None
         burned = estimate_burned_kcal_from_steps(steps, weight_kg)
         await msg.reply(f"{mention}, сегодня шагов: {steps} → примерно потрачено {burned} ккал (грубо).")
         return True
 
-    if ASK_BALANCE_RE.search(text):
-        intake, _, _ = await total_intake_today(chat_id, user_id)
-        steps = await steps_today(chat_id, user_id)
+    if intent == "balance":
+        intake, _, _, steps = await day_totals_today(chat_id, user_id)
         weight_kg = float(prof[2]) if prof else None
         burned = estimate_burned_kcal_from_steps(steps, weight_kg)
         balance = intake - burned
@@ -714,7 +1240,7 @@ async def answer_questions(msg: Message, mention: str, prof):
         await msg.reply(f"{mention}, баланс сегодня (очень примерно): {sign}{balance} ккал.\nСъел ~{intake}, шагами ~{burned}.")
         return True
 
-    if ASK_SUMMARY_RE.search(text):
+    if intent == "summary":
         await msg.reply(await day_summary_text(chat_id, user_id))
         return True
 
@@ -724,106 +1250,149 @@ async def answer_questions(msg: Message, mention: str, prof):
 # =======================
 # Handlers
 # =======================
-@dp.message(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}) & F.text)
+# команды (в т.ч. чужие и неизвестные) сюда не попадают — базу и regex на них не тратим
+@group_router.message(F.text & ~F.text.startswith("/"))
 async def on_text(msg: Message):
-    await ensure_chat(msg.chat.id)
     t = (msg.text or "").strip()
 
     user_id = msg.from_user.id
-    prof = await get_profile(msg.chat.id, user_id)
+    # болтовня без цифр, вопросов, реплаев и ожидающей правки — не трогаем базу вовсе
+    if not (msg.reply_to_message or (msg.chat.id, user_id) in _pending_fix_users
+            or HAS_DIGIT_RE.search(t) or any(kw in t.lower() for kw in ASK_HINTS)):
+        return
+
+    # независимые обращения к базе — параллельно; pending-fix (после кнопки) забираем тут же
+    _, prof, pending = await asyncio.gather(
+        ensure_chat(msg.chat.id),
+        get_profile(msg.chat.id, user_id),
+        take_pending_fix(msg.chat.id, user_id),
+    )
     name = prof[0] if prof else (msg.from_user.first_name or "Ты")
     mention = mention_user_html(msg, name)
 
-    # pending-fix (после кнопки)
-    pending = await get_pending_fix(msg.chat.id, user_id)
     if pending:
         bot_msg_id, created_at = pending
-        try:
-            created_dt = datetime.fromisoformat(created_at).astimezone(TZ)
-        except Exception:
-            created_dt = datetime.now(TZ)
 
         # TTL 10 минут
-        if datetime.now(TZ) - created_dt <= timedelta(minutes=10):
+        if time.time() - (created_at or 0) <= 10 * 60:
             corr = extract_correction_text(t)
             if corr:
-                meal = await find_meal_by_bot_message(msg.chat.id, bot_msg_id)
+                meal, goal = await asyncio.gather(
+                    find_meal_by_bot_message(msg.chat.id, bot_msg_id), get_goal(msg.chat.id),
+                )
                 if not meal:
-                    await clear_pending_fix(msg.chat.id, user_id)
                     return await msg.reply(f"{mention}, не нашёл запись для правки. Нажми ✏️ ещё раз.")
 
                 user_context = "нет"
                 if prof:
                     user_context = f"Имя: {prof[0]}, Рост: {prof[1]} см, Вес: {prof[2]} кг"
-                goal = await get_goal(msg.chat.id)
 
                 new_analysis = await reanalyze_from_text(goal, user_context, corr)
-                low, high = parse_kcal_range(new_analysis)
+                low, high = parse_kcal_range(parse_analysis(new_analysis))
                 new_title = corr[:120]
 
                 await log_correction(msg.chat.id, user_id, bot_msg_id, corr)
-                await update_meal_by_bot_message(msg.chat.id, bot_msg_id, new_title, low, high)
-                await clear_pending_fix(msg.chat.id, user_id)
+                await update_meal(meal[5], new_title, low, high)
 
                 return await msg.reply(f"{mention}, принял уточнение ✅\n\n{new_analysis}")
-        await clear_pending_fix(msg.chat.id, user_id)
 
     # Reply-правка на сообщение бота
     if msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.is_bot:
         corr = extract_correction_text(t)
         if corr:
             bot_msg_id = msg.reply_to_message.message_id
-            meal = await find_meal_by_bot_message(msg.chat.id, bot_msg_id)
+            meal, goal = await asyncio.gather(
+                find_meal_by_bot_message(msg.chat.id, bot_msg_id), get_goal(msg.chat.id),
+            )
             if meal:
                 user_context = "нет"
                 if prof:
                     user_context = f"Имя: {prof[0]}, Рост: {prof[1]} см, Вес: {prof[2]} кг"
-                goal = await get_goal(msg.chat.id)
 
                 new_analysis = await reanalyze_from_text(goal, user_context, corr)
-                low, high = parse_kcal_range(new_analysis)
+                low, high = parse_kcal_range(parse_analysis(new_analysis))
                 new_title = corr[:120]
 
                 await log_correction(msg.chat.id, user_id, bot_msg_id, corr)
-                await update_meal_by_bot_message(msg.chat.id, bot_msg_id, new_title, low, high)
+                await update_meal(meal[5], new_title, low, high)
                 return await msg.reply(f"{mention}, принял уточнение ✅\n\n{new_analysis}")
 
     # Вопросы
     if await answer_questions(msg, mention, prof):
         return
 
-    # Вес цифрой
-    mw = WEIGHT_RE.search(t)
-    if mw:
-        raw = mw.group(1).replace(",", ".")
-        try:
-            w = float(raw)
-        except ValueError:
-            w = None
-        if w and 30.0 <= w <= 300.0:
-            await save_weight(msg.chat.id, user_id, w)
-            return await msg.reply(f"{mention}, вес записал: {w:.1f} кг ✅")
-
-    # Шаги цифрой — и если это вечер (после 21:30) или рядом с напоминанием — сразу саммари
-    ms = STEPS_RE.search(t)
-    if ms:
-        s = int(ms.group(1))
-        if 300 <= s <= 100000:
-            await save_steps(msg.chat.id, user_id, s)
-            await msg.reply(f"{mention}, шаги записал: {s} ✅")
-
-            now = datetime.now(TZ)
-            if now.hour >= 21:  # чтобы работало “после вечернего отчета”
-                await msg.reply(await day_summary_text(msg.chat.id, user_id))
-            return
+    # Вес/шаги пишут коротко и цифрами — остальной текст через regex не гоняем
+    if len(t) > 64 or not HAS_DIGIT_RE.search(t):
+        return
 
+    m = NUMBER_RE.search(t)
+    if not m:
+        return
 
-@dp.message(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}) & F.photo)
+    # Вес цифрой
+    if m["w"] is not None:
+        w = parse_weight(m)
+        if w is not None:
+            return await record_weight(msg, mention, w)
+        # "350" не вес — может быть шагами
+        m = STEPS_RE.search(t)
+
+    # Шаги цифрой
+    s = parse_steps(m)
+    if s is not None:
+        return await record_steps(msg, mention, s)
+
+async def record_weight(msg: Message, mention: str, w: float):
+    await save_weight(msg.chat.id, msg.from_user.id, w)
+    await msg.reply(f"{mention}, вес записал: {w:.1f} кг ✅")
+
+async def record_steps(msg: Message, mention: str, s: int):
+    await save_steps(msg.chat.id, msg.from_user.id, s)
+    await msg.reply(f"{mention}, шаги записал: {s} ✅")
+
+    # если это вечер (после 21:00) или рядом с напоминанием — сразу саммари
+    now = datetime.now(TZ)
+    if now.hour >= 21:  # чтобы работало “после вечернего отчета”
+        # без цитаты, поэтому чья сводка — видно по упоминанию (вечером шаги скидывают несколько человек)
+        summary = await day_summary_text(msg.chat.id, msg.from_user.id)
+        await msg.answer(f"{mention}\n{summary}", disable_notification=True)
+
+
+# голое число в подписи к фото: "82" — вес, "8400" — шаги, "250"/"500" — скорее порция, идёт в анализ
+CAPTION_WEIGHT_MAX = 99
+CAPTION_STEPS_MIN = 1000
+
+@group_router.message(F.photo)
 async def on_food_photo(msg: Message):
     await ensure_chat(msg.chat.id)
 
+    # фото весов/шагомера с числом в подписи — записываем без Groq
+    cap = (msg.caption or "").strip()
+    if cap:
+        w = parse_weight(WEIGHT_RE.fullmatch(cap))
+        s = None if w is not None else parse_steps(STEPS_RE.fullmatch(cap))
+        # голое целое под фото еды — чаще граммы или калории ("250", "500"); без "вес"/"шаги" верим только явному
+        if cap.isdigit():
+            if w is not None and w > CAPTION_WEIGHT_MAX:
+                w = None
+            if s is not None and s < CAPTION_STEPS_MIN:
+                s = None
+        if w is not None or s is not None:
+            prof = await get_profile(msg.chat.id, msg.from_user.id)
+            mention = mention_user_html(msg, prof[0] if prof else (msg.from_user.first_name or "Ты"))
+            if w is not None:
+                return await record_weight(msg, mention, w)
+            return await record_steps(msg, mention, s)
+
+    # анализ фото долгий — отдаём воркеру чата и сразу освобождаем поллинг
+    photo_queue(msg.chat.id).put_nowait(msg)
+
+async def process_food_photo(msg: Message):
     user_id = msg.from_user.id
-    prof = await get_profile(msg.chat.id, user_id)
+    # независимые чтения и getFile в Telegram — параллельно
+    prof, goal, tg_file = await asyncio.gather(
+        get_profile(msg.chat.id, user_id), get_goal(msg.chat.id), bot.get_file(pick_photo(msg.photo).file_id),
+    )
     name = prof[0] if prof else (msg.from_user.first_name or "Ты")
     mention = mention_user_html(msg, name)
 
@@ -831,14 +1400,11 @@ async def on_food_photo(msg: Message):
     if prof:
         user_context = f"Имя: {prof[0]}, Рост: {prof[1]} см, Вес: {prof[2]} кг"
 
-    goal = await get_goal(msg.chat.id)
-    analysis = await analyze_food(msg.photo[-1].file_id, goal, user_context, msg.caption)
+    analysis = await analyze_food(tg_file, goal, user_context, msg.caption)
 
-    low, high = parse_kcal_range(analysis)
-    title = (msg.caption or "").strip()
-    if not title:
-        mm = re.search(r"Блюдо:\s*(.+)", analysis)
-        title = mm.group(1).strip() if mm else "Еда"
+    fields = parse_analysis(analysis)
+    low, high = parse_kcal_range(fields)
+    title = (msg.caption or "").strip() or fields.get("блюдо") or "Еда"
 
     out = f"{mention}, вот что вижу:\n\n{analysis}"
 
@@ -846,46 +1412,178 @@ async def on_food_photo(msg: Message):
     await save_meal(msg.chat.id, user_id, title, low, high, sent.message_id)
 
     # подсчёт дневных калорий и вывод прогресса
-    intake, meals_cnt, known_cnt = await total_intake_today(msg.chat.id, user_id)
-    out2 = f"{mention}, <b>сегодня уже</b>: ~{intake} ккал (приёмов: {meals_cnt})."
-    await msg.reply(out2)
+    async def send_progress():
+        intake, meals_cnt, known_cnt = await total_intake_today(msg.chat.id, user_id)
+        out2 = f"{mention}, <b>сегодня уже</b>: ~{intake} ккал (приёмов: {meals_cnt})."
+        # продолжение ответа выше: без цитаты и без повторного уведомления
+        await msg.answer(out2, disable_notification=True)
 
-    try:
-        await bot.edit_message_reply_markup(
-            chat_id=msg.chat.id,
-            message_id=sent.message_id,
-            reply_markup=correction_keyboard(sent.message_id)
-        )
-    except Exception:
-        pass
+    async def attach_fix_button():
+        try:
+            await bot.edit_message_reply_markup(
+                chat_id=msg.chat.id,
+                message_id=sent.message_id,
+                reply_markup=correction_keyboard(sent.message_id)
+            )
+        except Exception:
+            pass
+
+    await asyncio.gather(send_progress(), attach_fix_button())
 
 
 # =======================
-# Reminders
+# Photo workers (по одному на чат)
 # =======================
-async def send_to_bound(text: str):
-    for chat_id in await bound_chats():
+PHOTO_WORKER_IDLE_SEC = 300
+# при остановке столько ждём, пока воркеры доделают очередь; остальное отменяем
+PHOTO_DRAIN_SEC = float(os.getenv("PHOTO_DRAIN_SEC", "30"))
+
+_photo_workers: dict[int, tuple[asyncio.Queue, asyncio.Task]] = {}
+
+def photo_queue(chat_id: int) -> asyncio.Queue:
+    worker = _photo_workers.get(chat_id)
+    if worker is None:
+        q = asyncio.Queue()
+        worker = (q, asyncio.create_task(photo_worker(chat_id, q)))
+        _photo_workers[chat_id] = worker
+    return worker[0]
+
+async def photo_worker(chat_id: int, q: asyncio.Queue):
+    # фото одного чата обрабатываются по порядку, разные чаты — параллельно
+    while True:
         try:
-            await bot.send_message(chat_id, text)
+            msg = await asyncio.wait_for(q.get(), PHOTO_WORKER_IDLE_SEC)
+        except asyncio.TimeoutError:
+            if q.empty():
+                _photo_workers.pop(chat_id, None)
+                return
+            continue
+        if msg is None:  # stop_photo_workers: очередь до этой метки уже обработана
+            _photo_workers.pop(chat_id, None)
+            return
+        try:
+            await process_food_photo(msg)
         except Exception:
-            pass
+            log.exception("Photo worker error")
+
+async def stop_photo_workers():
+    # поллинг уже остановлен, новых фото нет: дообрабатываем очереди до БД и закрытия сессии
+    workers = list(_photo_workers.values())
+    if not workers:
+        return
+    for q, _ in workers:
+        q.put_nowait(None)
+    _, pending = await asyncio.wait([t for _, t in workers], timeout=PHOTO_DRAIN_SEC)
+    if pending:
+        # у незавершённого воркера в очереди лежит метка, а одно фото — в работе: сумма qsize() и есть потери
+        lost = sum(q.qsize() for q, t in workers if t in pending)
+        log.warning("Photo workers not done after %gs, dropping %d photos", PHOTO_DRAIN_SEC, lost)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    _photo_workers.clear()
+
+
+# =======================
+# Reminders
+# =======================
+# Telegram: ~30 сообщений/сек на бота
+SEND_RATE_PER_SEC = 30
+SEND_CONCURRENCY = 25
+
+class RateLimiter:
+    """Token bucket: не больше rate вызовов wait() в секунду, общий на весь бот."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+send_limiter = RateLimiter(SEND_RATE_PER_SEC)
+send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
+
+async def send_to_bound(text: str):
+    # со звуком намеренно: напоминание (вода, шаги, взвешивание) и есть повод отвлечь человека
+    # модель метода валидируем один раз, для каждого чата — дешёвая копия без валидации
+    method = SendMessage(chat_id=0, text=text)
+
+    async def send_one(chat_id: int):
+        async with send_sem:
+            await send_limiter.wait()
+            try:
+                await bot(method.model_copy(update={"chat_id": chat_id}))
+            except TelegramRetryAfter as e:
+                # флуд-контроль: ждём сколько просит Telegram и пробуем ещё раз
+                await asyncio.sleep(e.retry_after)
+                try:
+                    await bot(method.model_copy(update={"chat_id": chat_id}))
+                except Exception:
+                    pass
+            except TelegramForbiddenError:
+                # бота выгнали из чата — не тратим на него следующие рассылки
+                await set_bound(chat_id, 0)
+            except Exception:
+                pass
+
+    await asyncio.gather(*(send_one(chat_id) for chat_id in list(BOUND_CHATS)))
 
 async def evening_steps_reminder():
     # только напоминание, саммари выдаём после того как человек скинул шаги
     await send_to_bound("🚶 22:00 — скинь скрин шагов или напиши число шагов (например: 8400). После этого дам сводку за день.")
 
 def setup_scheduler():
-    sched = AsyncIOScheduler(timezone=TZ)
+    # три редких cron-задачи с общим send_to_bound; если цикл подвис — одна отправка с опозданием, а не пропуск или пачка
+    sched = AsyncIOScheduler(timezone=TZ, job_defaults={"coalesce": True, "misfire_grace_time": 30})
     sched.add_job(send_to_bound, "cron", hour=WATER_HOUR, minute=WATER_MIN, args=["🥤 07:00 — стакан воды."])
     sched.add_job(evening_steps_reminder, "cron", hour=STEPS_HOUR, minute=STEPS_MIN)
     sched.add_job(send_to_bound, "cron", day_of_week=WEIGH_DOW, hour=WEIGH_HOUR, minute=WEIGH_MIN, args=["⚖️ Взвешивание: скинь фото весов или напиши вес (например: 79.4)."])
     sched.start()
+    return sched
 
 
 async def main():
+    log_listener.start()
     await init_db()
-    setup_scheduler()
-    await dp.start_polling(bot)
+    await db_pool.open()
+    writer = asyncio.create_task(db_writer())
+    warmup = asyncio.create_task(warm_groq())
+    BOUND_CHATS.update(await bound_chats())
+    sched = setup_scheduler()
+    try:
+        # сессию бота закрываем сами — после того как воркеры фото отправят последние ответы
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        # сначала останавливаем напоминания: иначе задача может сработать на закрытой базе или сессии
+        sched.shutdown(wait=False)
+        await stop_photo_workers()
+        await flush_writes()
+        writer.cancel()
+        warmup.cancel()
+        for task in (writer, warmup):
+            with suppress(asyncio.CancelledError):
+                await task
+        await db_pool.close()
+        await bot.session.close()
+        if groq_client:
+            await groq_client.close()
+        log_listener.stop()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())